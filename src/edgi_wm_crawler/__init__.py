@@ -1,20 +1,22 @@
-from concurrent.futures import as_completed, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
-from itertools import batched
+from itertools import batched, chain
 import json
 from pathlib import Path
 from sys import exit, stderr
-from typing import Iterable
-from web_monitoring.db import Client as DbClient
+from typing import Generator, Iterable
 from .seeds import (
     active_urls,
-    check_connection_error,
+    check_connection_errors,
     format_text,
     format_browsertrix,
+    group_hosts_by_domain,
     group_urls,
+    write_browsertrix_groups,
 )
 
 PRECHECK_FILE_NAME = 'precheck.log.json'
+IMPORT_BATCH_SIZE = 500
 
 
 def main() -> None:
@@ -45,6 +47,15 @@ def main() -> None:
         default=4,
         help='How many workers (browserstrix only).'
     )
+    seeds_command.add_argument(
+        '--cache-ttl',
+        type=int,
+        default=0,
+        help=(
+            'Reuse the list of active URLs from a previous run if it is less '
+            'than this many seconds old (default: 0, always load fresh data).'
+        )
+    )
     seeds_command.add_argument(
         '--precheck-connections',
         type=bool,
@@ -53,6 +64,12 @@ def main() -> None:
             'connection timeouts, etc.).'
         )
     )
+    seeds_command.add_argument(
+        '--precheck-workers',
+        type=int,
+        default=32,
+        help='How many hosts to pre-check at once (with `--precheck-connections`).'
+    )
     seeds_command.set_defaults(func=generate_seeds)
 
     multi_seeds_command = subparsers.add_parser(
@@ -108,6 +125,15 @@ def main() -> None:
         default=Path('.'),
         help='Directory to write seed lists to.'
     )
+    multi_seeds_command.add_argument(
+        '--cache-ttl',
+        type=int,
+        default=0,
+        help=(
+            'Reuse the list of active URLs from a previous run if it is less '
+            'than this many seconds old (default: 0, always load fresh data).'
+        )
+    )
     multi_seeds_command.add_argument(
         '--precheck-connections',
         action='store_true',
@@ -116,6 +142,12 @@ def main() -> None:
             'connection timeouts, etc.).'
         )
     )
+    multi_seeds_command.add_argument(
+        '--precheck-workers',
+        type=int,
+        default=32,
+        help='How many hosts to pre-check at once (with `--precheck-connections`).'
+    )
     multi_seeds_command.set_defaults(func=generate_multi_seeds)
 
     import_precheck_command = subparsers.add_parser('import-precheck', help='Import precheck results to web-montioring-db')
@@ -130,11 +162,12 @@ def main() -> None:
     args.func(**vars(args))
 
 
-def generate_seeds(*, format, pattern, tag: list[str] | None, workers, precheck_connections, **_kwargs) -> None:
+def generate_seeds(*, format, pattern, tag: list[str] | None, workers, precheck_connections, precheck_workers: int = 32, cache_ttl: int = 0, **_kwargs) -> None:
     print(f'Generating seeds as {format}...', file=stderr)
-    urls = active_urls(pattern=pattern, tags=tag)
+    urls = active_urls(pattern=pattern, tags=tag, cache_ttl=cache_ttl)
     if precheck_connections:
-        urls = filter_unreachable_hosts(urls)
+        host_groups = filter_unreachable_hosts(group_urls(urls, by='host'), workers=precheck_workers)
+        urls = chain.from_iterable(host_groups.values())
     if format == 'text':
         print(format_text(urls))
     elif format == 'browsertrix':
@@ -144,19 +177,24 @@ def generate_seeds(*, format, pattern, tag: list[str] | None, workers, precheck_
         exit(1)
 
 
-def generate_multi_seeds(*, pattern, tag: list[str] | None, workers: int, output: Path, size: int, single_group_size: int = 0, precheck_connections: bool, **_kwargs) -> None:
+def generate_multi_seeds(*, pattern, tag: list[str] | None, workers: int, output: Path, size: int, single_group_size: int = 0, precheck_connections: bool, precheck_workers: int = 32, cache_ttl: int = 0, **_kwargs) -> None:
     single_group_size = single_group_size or size
 
     print(f'Writing seed files to "{output}/*"...', file=stderr)
     output.mkdir(parents=True, exist_ok=True)
     filename_template = '{name}.seeds.yaml'
 
+    # Tuples of (file name, URLs grouped by domain, Browsertrix workers) to
+    # write. Keeping the groups means we don't have to parse the URLs again.
     files = []
 
-    urls = active_urls(pattern=pattern, tags=tag)
+    urls = active_urls(pattern=pattern, tags=tag, cache_ttl=cache_ttl)
+    # Only parse each URL once, when grouping by host. Everything after that
+    # (prechecks, grouping by domain) works from the hosts.
+    host_groups = group_urls(urls, by='host')
     if precheck_connections:
-        urls = filter_unreachable_hosts(urls, output_dir=output)
-    core_groups = group_urls(urls, by='domain')
+        host_groups = filter_unreachable_hosts(host_groups, output_dir=output, workers=precheck_workers)
+    core_groups = group_hosts_by_domain(host_groups)
 
     oversized = [k for k, v in core_groups.items() if len(v) >= size]
     for group in oversized:
@@ -164,55 +202,65 @@ def generate_multi_seeds(*, pattern, tag: list[str] | None, workers: int, output
         for index, subset in enumerate(batched(urls, single_group_size)):
             file_group = group.replace('.', '-')
             filename = filename_template.format(name=f'{file_group}-{index + 1}')
-            with open(output / filename, 'w') as file:
-                file.write(format_browsertrix(subset, workers=1))
-                files.append(filename)
-                print(f'Wrote "{file.name}"', file=stderr)
+            files.append((filename, {group: subset}, 1))
 
+    # Pack the remaining groups into as few seed lists as we can with
+    # first-fit decreasing: take groups from largest to smallest and put each
+    # one in the first seed list that still has room for it.
     subsets = []
-    while len(core_groups):
-        subset = []
-        remaining = size
-        for group, urls in core_groups.copy().items():
-            if len(urls) <= remaining:
-                core_groups.pop(group)
-                subset.extend(urls)
-                remaining -= len(urls)
-                if remaining == 0:
-                    break
-
-        subsets.append(subset)
+    remaining = []
+    for group, urls in sorted(core_groups.items(), key=lambda item: len(item[1]), reverse=True):
+        for index, space in enumerate(remaining):
+            if len(urls) <= space:
+                subsets[index][group] = urls
+                remaining[index] -= len(urls)
+                break
+        else:
+            subsets.append({group: urls})
+            remaining.append(size - len(urls))
 
     for index, subset in enumerate(subsets):
         filename = filename_template.format(name=f'other-{index + 1}')
-        with open(output / filename, 'w') as file:
-            file.write(format_browsertrix(subset, workers=workers))
-            files.append(filename)
-            print(f'Wrote "{file.name}"', file=stderr)
+        files.append((filename, subset, workers))
+
+    # Formatting is CPU-bound and each file is independent, so format and
+    # write them in separate processes to make use of all available cores.
+    with ProcessPoolExecutor() as executor:
+        paths = executor.map(
+            write_seed_file,
+            [output / filename for filename, _, _ in files],
+            [subset for _, subset, _ in files],
+            [file_workers for _, _, file_workers in files],
+        )
+        for path in paths:
+            print(f'Wrote "{path}"', file=stderr)
 
-    print(json.dumps([f.split('.seeds')[0] for f in files]))
+    print(json.dumps([filename.split('.seeds')[0] for filename, _, _ in files]))
+
+
+def write_seed_file(path: Path, groups: dict[str, Iterable[str]], workers: int) -> Path:
+    with path.open('w') as file:
+        write_browsertrix_groups(groups, file, workers=workers)
+    return path
 
 
 def import_precheck(*, seeds_dir: Path, **_kwargs) -> None:
+    from web_monitoring.db import Client as DbClient
+
     hosts = {}
     precheck_path = seeds_dir / PRECHECK_FILE_NAME
     with precheck_path.open('r') as precheck_file:
         hosts = json.load(precheck_file)
 
-    error_records = []
-    for info in hosts.values():
-        for url in info.get('urls', []):
-            error_records.append({
-                'url': url,
-                'capture_time': info['timestamp'],
-                'network_error': info['error'],
-                'source_type': 'edgi_crawl',
-                'source_metadata': {},
-            })
+    batches = list(batched(precheck_error_records(hosts), IMPORT_BATCH_SIZE))
+
+    print(f'Importing {sum(len(batch) for batch in batches)} recordings of network errors...')
+    # Upload several smaller batches at once instead of one at a time.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        batch_ids = executor.map(add_versions, batches)
+        import_ids = [import_id for ids in batch_ids for import_id in ids]
 
-    print(f'Importing {len(error_records)} recordings of network errors...')
     client = DbClient.from_env()
-    import_ids = client.add_versions(error_records)
     errors = client.monitor_import_statuses(import_ids)
     total = sum(len(job_errors) for job_errors in errors.values())
     if total > 0:
@@ -224,36 +272,73 @@ def import_precheck(*, seeds_dir: Path, **_kwargs) -> None:
         print(f'{len(import_ids)} import jobs completed successfully.')
 
 
-def filter_unreachable_hosts(urls: Iterable[str], output_dir: Path | None = None) -> list[str]:
-    host_groups = group_urls(urls, by='host')
+def precheck_error_records(hosts: dict[str, dict]) -> Generator[dict, None, None]:
+    """
+    Create web-monitoring-db version records for the URLs in a precheck log.
+    Each URL is only recorded once per timestamp, even if it is listed under
+    more than one host.
+    """
+    seen = set()
+    for info in hosts.values():
+        for url in info.get('urls', []):
+            key = (url, info['timestamp'])
+            if key in seen:
+                continue
 
+            seen.add(key)
+            yield {
+                'url': url,
+                'capture_time': info['timestamp'],
+                'network_error': info['error'],
+                'source_type': 'edgi_crawl',
+                'source_metadata': {},
+            }
+
+
+def add_versions(versions: Iterable[dict]) -> tuple[int, ...]:
+    from web_monitoring.db import Client as DbClient
+
+    # The DB client's HTTP session is not thread-safe, so each call gets its own.
+    return tuple(DbClient.from_env().add_versions(versions))
+
+
+def filter_unreachable_hosts(
+    host_groups: dict[str, list[str]],
+    output_dir: Path | None = None,
+    workers: int = 32
+) -> dict[str, list[str]]:
+    """
+    Check whether the server for each host is reachable. Takes and returns
+    dicts of hosts and their URLs (as from ``group_urls(urls, by='host')``);
+    the result only includes reachable hosts.
+    """
     print(f'Pre-checking {len(host_groups)} hosts for connection failures...', file=stderr)
 
-    urls = []
+    # Record every host as checked at the start of the precheck. It only takes
+    # a few minutes, and this saves formatting a new timestamp for each host.
+    timestamp = datetime.now(tz=timezone.utc).isoformat().replace('+00:00', 'Z')
+    reachable = {}
     log_data = {}
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        host_futures = {
-            executor.submit(check_connection_error, host_urls[0]): host
-            for host, host_urls in host_groups.items()
+    # Only check the first URL for each host.
+    host_urls = {urls[0]: host for host, urls in host_groups.items()}
+    for url, error in check_connection_errors(host_urls, workers=workers):
+        host = host_urls[url]
+        log_data[host] = {
+            'timestamp': timestamp,
+            'error': error,
+            'urls': [],
         }
-        for future in as_completed(host_futures):
-            host = host_futures[future]
-            error = future.result()
-            log_data[host] = {
-                'timestamp': datetime.now(tz=timezone.utc).isoformat().replace('+00:00', 'Z'),
-                'error': error,
-                'urls': [],
-            }
-            if error:
-                print(f'❌ {host} (Error: {error})', file=stderr)
-                log_data[host]['urls'] = host_groups[host]
-            else:
-                print(f'✅ {host}', file=stderr)
-                urls.extend(host_groups[host])
+        if error:
+            print(f'❌ {host} (Error: {error})', file=stderr)
+            log_data[host]['urls'] = host_groups[host]
+        else:
+            print(f'✅ {host}', file=stderr)
+            reachable[host] = host_groups[host]
 
     if output_dir:
         log_path = output_dir / PRECHECK_FILE_NAME
         with log_path.open('w') as log_file:
-            json.dump(log_data, log_file)
+            # `json.dumps()` uses the C encoder; `json.dump()` never does.
+            log_file.write(json.dumps(log_data))
 
-    return urls
+    return reachable
@@ -1,17 +1,22 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+from io import StringIO
 from itertools import chain
-import requests
-from requests.adapters import HTTPAdapter
+import json
+import os
+from pathlib import Path
 import re
+from sys import stderr
+from tempfile import NamedTemporaryFile
 import threading
-from typing import Any, Generator, Iterable, Literal
+import time
+from typing import Any, Generator, Iterable, Literal, TextIO
 from urllib.parse import urlsplit
-from urllib3.util import Retry
-import yaml
-from web_monitoring.db import Client as DbClient
 
 
-IGNORE_HOSTS = (
+IGNORE_HOSTS = frozenset((
     # TODO: remove these entirely. These are all servers that are known to be
     # dead and that could cause crawl problems, but we now run prechecks that
     # largely resolve those issues and help us actually record that the server
@@ -31,9 +36,27 @@ IGNORE_HOSTS = (
     # 'nca2023.globalchange.gov',
     # 'sealevel.globalchange.gov',
     # 'liftoff.energy.gov',
-)
+))
+
+# Subdomains of ignored hosts are ignored too. `str.endswith()` can check all
+# of these in one call.
+_IGNORE_HOST_SUFFIXES = tuple(f'.{host}' for host in IGNORE_HOSTS)
+
+_SCHEME_AND_HOST_PATTERN = re.compile(r'^[^:/?#]+://[^/?#]*')
+
+
+def _normalize_url(url: str) -> str:
+    """
+    Normalize a URL for comparison against other URLs: lower-case the scheme
+    and host, and drop any trailing slashes.
+    """
+    match = _SCHEME_AND_HOST_PATTERN.match(url)
+    if match:
+        url = match.group(0).lower() + url[match.end():]
+    return url.rstrip('/')
 
-IGNORE_URLS = (
+
+IGNORE_URLS = frozenset(_normalize_url(url) for url in (
     # These are known to return 404 status codes with empty bodies (and we
     # expect them to stay that way). This breaks Browsertrix right now:
     # https://github.com/webrecorder/browsertrix-crawler/issues/789
@@ -41,71 +64,187 @@ IGNORE_URLS = (
     'https://www.whitehouse.gov/wp-content/uploads/2023/03/FTAC_Report_03222023_508.pdf',
     'https://www.whitehouse.gov/wp-content/uploads/2023/09/National-Climate-Resilience-Framework-FINAL.pdf',
     'https://www.whitehouse.gov/wp-content/uploads/2023/06/OSTP-SCIENTIFIC-INTEGRITY-POLICY.pdf',
-)
+))
+
+# Max number of pages web-monitoring-db returns per request.
+PAGES_CHUNK_SIZE = 1000
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'edgi_wm_crawler'
 
 
-def active_urls(pattern: str | None = None, tags: list[str] | None = None) -> Generator[str, None, None]:
-    # TODO: pattern negation support should be built into the API.
-    antipattern = None
+def active_urls(
+    pattern: str | None = None,
+    tags: list[str] | None = None,
+    cache_ttl: float = 0
+) -> Generator[str, None, None]:
+    # TODO: pattern negation support should be built into the API. Until then,
+    # a negated pattern means fetching *every* active page and filtering here.
+    # (`get_pages()` has no way to exclude URLs, so the ignore lists below
+    # can't be pushed into the query either.)
+    exclude = None
     if pattern and pattern.startswith('!'):
-        antipattern = re.compile('^' + pattern[1:].replace('*', '.*') + '$')
+        exclude = _compile_url_pattern(pattern[1:]).match
         pattern = None
 
-    urls = (
-        page['url']
-        for page in DbClient.from_env().get_pages(
-            active=True,
-            url=pattern,
-            tags=tags,
-        )
-        if (
-            page['url'] not in IGNORE_URLS
-            and urlsplit(page['url']).hostname not in IGNORE_HOSTS
-        )
-    )
-    if antipattern:
-        urls = (
-            url for url in urls
-            if not antipattern.match(url)
-        )
+    # This runs for every active page, so do all the filtering in one pass
+    # and keep lookups local.
+    ignore_urls = IGNORE_URLS
+    ignore_hosts = IGNORE_HOSTS
+    ignore_host_suffixes = _IGNORE_HOST_SUFFIXES
+    normalize = _normalize_url
+    get_hostname = _hostname
+    for url in load_active_urls(pattern=pattern, tags=tags, cache_ttl=cache_ttl):
+        if normalize(url) in ignore_urls:
+            continue
+
+        host = get_hostname(url) or ''
+        if host in ignore_hosts or host.endswith(ignore_host_suffixes):
+            continue
+
+        if exclude and exclude(url):
+            continue
+
+        yield url
+
+
+@lru_cache(maxsize=64)
+def _compile_url_pattern(pattern: str) -> re.Pattern[str]:
+    """
+    Compile a web-monitoring-db style URL pattern (where ``*`` is a wildcard
+    and everything else is literal) to a regular expression.
+    """
+    return re.compile('^' + re.escape(pattern).replace(r'\*', '.*') + '$')
+
+
+def load_active_urls(
+    pattern: str | None = None,
+    tags: list[str] | None = None,
+    cache_ttl: float = 0
+) -> Iterable[str]:
+    """
+    Get the URLs of all active pages matching a DB URL pattern and tags. If
+    ``cache_ttl`` is set, results are saved to disk and reused by later calls
+    with the same arguments for that many seconds.
+    """
+    if cache_ttl <= 0:
+        return _fetch_active_urls(pattern, tags)
+
+    cache_key = hashlib.sha1(json.dumps([pattern, sorted(tags or [])]).encode()).hexdigest()
+    cache_path = CACHE_DIR / f'pages-{cache_key}.json'
+    try:
+        if time.time() - cache_path.stat().st_mtime < cache_ttl:
+            with cache_path.open('r') as cache_file:
+                urls = json.load(cache_file)
+            print(f'Using cached active URLs from "{cache_path}"', file=stderr)
+            return urls
+    except (OSError, ValueError):
+        # Missing or unreadable, so treat it as a cache miss.
+        pass
+
+    urls = list(_fetch_active_urls(pattern, tags))
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and move it into place so an interrupted run
+    # (or another run writing at the same time) can't leave a partial file.
+    with NamedTemporaryFile('w', dir=cache_path.parent, suffix='.tmp', delete=False) as cache_file:
+        try:
+            cache_file.write(json.dumps(urls))
+        except BaseException:
+            cache_file.close()
+            os.unlink(cache_file.name)
+            raise
+    os.replace(cache_file.name, cache_path)
 
     return urls
 
 
-def format_text(urls: Iterable[str]) -> str:
-    return ''.join(
-        f'{url}\n'
-        for url in sorted(urls)
+def _fetch_active_urls(pattern: str | None, tags: list[str] | None) -> Generator[str, None, None]:
+    # Heavy imports are deferred so the CLI starts quickly (e.g. for `--help`).
+    from web_monitoring.db import Client as DbClient
+
+    pages = DbClient.from_env().get_pages(
+        active=True,
+        url=pattern,
+        tags=tags,
+        # Results come back one chunk per request, so ask for the biggest
+        # chunks the API allows to keep the number of round-trips down.
+        chunk_size=PAGES_CHUNK_SIZE,
     )
+    for page in pages:
+        yield page['url']
+
+
+def format_text(urls: Iterable[str]) -> str:
+    sorted_urls = sorted(urls)
+    if not sorted_urls:
+        return ''
+
+    return '\n'.join(sorted_urls) + '\n'
+
+
+# URLs that are safe to write as plain (unquoted) YAML scalars without any
+# escaping: printable ASCII, no spaces, and not ending in a colon.
+_PLAIN_YAML_URL_PATTERN = re.compile(r'^https?://[!-~]*[!-9;-~]\Z')
+
+
+def _yaml_quote(url: str) -> str:
+    """
+    Format a URL as a YAML scalar. Nearly all URLs can be written as-is;
+    anything else is double-quoted, with non-printable, non-ASCII, and quote
+    characters escaped.
+    """
+    if _PLAIN_YAML_URL_PATTERN.match(url):
+        return url
+
+    return '"' + ''.join(
+        char if ' ' <= char <= '~' and char not in '"\\' else f'\\U{ord(char):08x}'
+        for char in url
+    ) + '"'
+
+
+@lru_cache(maxsize=None)
+def _yaml_dumper() -> type:
+    # Use libyaml's much faster emitter when PyYAML was built with it.
+    try:
+        from yaml import CSafeDumper
+        return CSafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+        return SafeDumper
 
 
 def format_browsertrix(urls: Iterable[str], *, workers: int = 4, **options: Any) -> str:
+    output = StringIO()
+    write_browsertrix_groups(group_urls(urls, by='domain'), output, workers=workers, **options)
+    return output.getvalue()
+
+
+def write_browsertrix_groups(
+    groups: dict[str, Iterable[str]],
+    file: TextIO,
+    *,
+    workers: int = 4,
+    **options: Any
+) -> None:
+    """
+    Write a Browsertrix config for URLs that are already grouped by domain (as
+    from ``group_urls(urls, by='domain')``) to a file. Seeds are written as
+    they are generated, so the whole config is never built up in memory.
+    """
     # Do some funky sorting to optimize for Browsertrix. We want arcgis URLs
     # all together or in a separate crawl because they tend to put a huge
     # amount of memory pressure on the browser, causing hangs or crashes.
     #
     # For other URLs we interleave the domains so that each one is receiving
     # a minimal rate of requests and we are less likely to trip crawl blockers.
-    groups = group_urls(urls, by='domain')
-    arcgis = groups.pop('arcgis', [])
-    sorted_urls = chain(arcgis, interleave(*groups.values()))
+    arcgis = groups.get('arcgis', [])
+    sorted_urls = chain(arcgis, interleave(*(
+        urls for group, urls in groups.items() if group != 'arcgis'
+    )))
 
-    seeds = []
-    for url in sorted_urls:
-        if '#' in url:
-            seeds.append({
-                'url': url,
-                # This *should* be `scopeType: page-spa`, so that we can record
-                # muliple fragment URLs of a given base, but there is a bug
-                # with it in Browsertrix v1.14.0:
-                # https://github.com/webrecorder/browsertrix-crawler/issues/1129
-                'scopeType': 'prefix',
-                'depth': 0
-            })
-        else:
-            seeds.append(url)
+    import yaml
+    dumper = _yaml_dumper()
 
-    return yaml.safe_dump({
+    yaml.dump({
         'workers': workers,
         'saveStateHistory': workers,
         'scopeType': 'page',
@@ -134,87 +273,274 @@ def format_browsertrix(urls: Iterable[str], *, workers: int = 4, **options: Any)
             'operator': '"Environmental Data & Governance Initiative" <contact@envirodatagov.org>',
             **options.get('warcinfo', {})
         },
-        'seeds': seeds
-    })
+    }, file, Dumper=dumper)
+
+    first_url = next(sorted_urls, None)
+    if first_url is None:
+        file.write('seeds: []\n')
+        return
+
+    # The seed list is nearly all of the output and has a fixed shape, so
+    # write it directly instead of running it through the much slower generic
+    # YAML emitter.
+    file.write('seeds:\n')
+    write = file.write
+    quote = _yaml_quote
+    for url in chain((first_url,), sorted_urls):
+        if '#' in url:
+            # This *should* be `scopeType: page-spa`, so that we can record
+            # muliple fragment URLs of a given base, but there is a bug
+            # with it in Browsertrix v1.14.0:
+            # https://github.com/webrecorder/browsertrix-crawler/issues/1129
+            write(f'- url: {quote(url)}\n  scopeType: prefix\n  depth: 0\n')
+        else:
+            write(f'- {quote(url)}\n')
 
 
 def group_urls(
     urls: Iterable[str],
     by: Literal['host', 'domain'] = 'domain'
 ) -> dict[str, list[str]]:
+    if by not in ('host', 'domain'):
+        raise ValueError('"by" must be "host" or "domain"')
+
+    # This is the hot loop for large seed lists, so decide the grouping mode
+    # once up front and keep lookups local.
+    by_host = by == 'host'
+    get_hostname = _hostname
+    get_domain_group = _domain_group
     url_groups: dict[str, list[str]] = defaultdict(list)
     for url in urls:
-        parsed = urlsplit(url)
-        assert parsed.hostname, f'No hostname: "{url}"'
-
-        if by == 'host':
-            group = parsed.hostname
-        elif by == 'domain':
-            group = '.'.join(parsed.hostname.split('.')[-2:])
-            if 'arcgis' in parsed.hostname:
-                group = 'arcgis'
+        hostname = get_hostname(url)
+        if not hostname:
+            # One bad URL in the DB shouldn't stop a whole crawl.
+            print(f'Skipping URL with no hostname: "{url}"', file=stderr)
+            continue
+
+        if by_host:
+            group = hostname
         else:
-            raise ValueError('"by" must be "host" or "domain"')
+            group = get_domain_group(hostname)
 
         url_groups[group].append(url)
 
     return url_groups
 
 
+def group_hosts_by_domain(host_groups: dict[str, list[str]]) -> dict[str, list[str]]:
+    """
+    Regroup the output of ``group_urls(urls, by='host')`` by domain, without
+    having to parse all the URLs again.
+    """
+    url_groups: dict[str, list[str]] = defaultdict(list)
+    for hostname, urls in host_groups.items():
+        url_groups[_domain_group(hostname)].extend(urls)
+
+    return url_groups
+
+
+# Most URLs share a handful of hosts, so remember each host's group.
+@lru_cache(maxsize=4096)
+def _domain_group(hostname: str) -> str:
+    # Arcgis URLs get special handling, so they are always grouped together.
+    if 'arcgis' in hostname:
+        return 'arcgis'
+
+    # Last two labels of the hostname, without splitting it up into a list.
+    rest, dot, last = hostname.rpartition('.')
+    if not dot:
+        return hostname
+    return f'{rest.rpartition(".")[2]}.{last}'
+
+
+# Matches the hostname of a typical URL, skipping over any user info. The
+# lookahead makes sure we stopped at the end of the host (and port) and not
+# partway through something unusual, which is left to `urlsplit()`.
+_HOSTNAME_PATTERN = re.compile(
+    r'^[a-z][a-z0-9+.-]*://(?:[^/?#@]*@)?([^/?#@:\[\]]+)(?=(?::\d*)?(?:[/?#]|$))',
+    re.IGNORECASE
+)
+
+
+def _hostname(url: str) -> str | None:
+    """
+    Get the lower-cased hostname of a URL. This is a lot cheaper than
+    ``urlsplit(url).hostname`` for ordinary URLs, and falls back to it for
+    anything unusual.
+    """
+    match = _HOSTNAME_PATTERN.match(url)
+    if match:
+        return match.group(1).lower()
+    return urlsplit(url).hostname
+
+
 def interleave(*iterables):
-    iterators = [iter(iterable) for iterable in iterables]
+    iterators = deque(iter(iterable) for iterable in iterables)
     while iterators:
-        for iterator in iterators:
-            try:
-                yield next(iterator)
-            except StopIteration:
-                iterators.remove(iterator)
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+
+        iterators.append(iterator)
+        yield item
+
+
+def check_connection_errors(
+    urls: Iterable[str],
+    workers: int = 32
+) -> Generator[tuple[str, str | None], None, None]:
+    """
+    Run ``check_connection_error()`` for many URLs concurrently. Yields a
+    ``(url, error)`` tuple for each URL as soon as its check finishes.
+    """
+    # This is almost entirely waiting on the network, so we can afford a lot
+    # more workers than CPUs.
+    with ThreadPoolExecutor(max_workers=workers,
+                            initializer=_init_requests_thread) as executor:
+        futures = {
+            executor.submit(check_connection_error, url): url
+            for url in urls
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
 
 # Requests is not thread-safe, so store a separate session for each thread.
 thread_requests = threading.local()
 
 
+def _make_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    session = requests.Session()
+    # status=0 -> only retry network failures, not non-2xx HTTP statuses.
+    retries = Retry(total=2, status=0, backoff_factor=2)
+    # Each thread checks many different hosts, and lots of them redirect
+    # to the same few servers (e.g. `www.epa.gov`), so keep pools around
+    # for far more hosts than the default (10) to reuse those connections.
+    adapter = HTTPAdapter(pool_connections=128, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _init_requests_thread() -> None:
+    thread_requests.session = _make_session()
+
+
 def check_connection_error(url: str) -> str | None:
     """
     Is it possible to connect to this server/hostname? Returns ``None`` for
     successful connections, otherwise a string indicating the type of
     connection failure.
     """
-    if not hasattr(thread_requests, 'session'):
-        thread_requests.session = requests.Session()
-        # status=0 -> only retry network failures, not non-2xx HTTP statuses.
-        retries = Retry(total=2, status=0, backoff_factor=2)
-        thread_requests.session.mount('https://', HTTPAdapter(max_retries=retries))
-        thread_requests.session.mount('http://', HTTPAdapter(max_retries=retries))
-
-    # NOTE: we currently use a GET request here because some servers respond
-    # to HEAD requests negatively(!) (really interestingly, `www.ncei.noaa.gov`
-    # will respond to a HEAD request from cURL but not other tools (seems to be
-    # based on the `User-Agent` header). Anyway, the simplest fix is to do a
-    # full GET, although that's not fun if the response happens to be large!
-    # It might be nicer to start with HEAD and fall back to GET on connection
-    # resets and timeouts.
-    response = None
+    import requests
+
     try:
-        response = thread_requests.session.get(url, timeout=(60, 10))
-        response.content
+        session = thread_requests.session
+    except AttributeError:
+        # Threads from `check_connection_errors()` already have a session, but
+        # this might be called from somewhere else.
+        _init_requests_thread()
+        session = thread_requests.session
+
+    # NOTE: some servers respond to HEAD requests negatively(!) (really
+    # interestingly, `www.ncei.noaa.gov` will respond to a HEAD request from
+    # cURL but not other tools (seems to be based on the `User-Agent` header).
+    # So we start with HEAD, which is cheapest, but fall back to GET if the
+    # server drops the connection, times out waiting for a response, or says
+    # HEAD is not allowed. Errors at the connection level (DNS, refused, etc.)
+    # won't go any differently with GET, so those are returned right away.
+    try:
+        with session.head(url, timeout=(60, 10), allow_redirects=True) as response:
+            if response.status_code not in (405, 501):
+                return None
     except requests.exceptions.ConnectionError as error:
-        message = str(error)
-        if 'NameResolutionError' in message:
-            return 'ERR_NAME_NOT_RESOLVED'
-        elif 'ConnectTimeoutError' in message:
-            return 'timeout'
-        elif 'RemoteDisconnected' in message:
-            return 'ERR_CONNECTION_RESET'
-        elif 'Connection refused' in message:
-            return 'ERR_CONNECTION_REFUSED'
-        else:
-            # Ignore other types of connection errors, e.g. SSL failures, which
-            # browsers (and our crawler) may handle less strictly.
-            return None
+        from urllib3.exceptions import ReadTimeoutError
+
+        # Read timeouts that run out of retries come through as connection
+        # errors, not `requests.exceptions.Timeout`.
+        if not isinstance(_connection_error_cause(error), ReadTimeoutError):
+            error_type = _connection_error_type(error)
+            if error_type != 'ERR_CONNECTION_RESET':
+                return error_type
+    except Exception:
+        return None
+
+    # Stream the GET and never read the body: getting the status line and
+    # headers back is enough to know the server is reachable, and we don't
+    # want to download a large file just to find that out.
+    try:
+        with session.get(url, timeout=(60, 10), stream=True):
+            pass
+    except requests.exceptions.ConnectionError as error:
+        return _connection_error_type(error)
     except Exception:
         return None
-    finally:
-        if response:
-            response.close()
+
+
+# Fallback for classifying connection errors whose underlying exception we
+# couldn't dig out by type (see `_connection_error_type()`).
+_CONNECTION_ERROR_PATTERN = re.compile(
+    r'NameResolutionError|ConnectTimeoutError|RemoteDisconnected|Connection refused'
+)
+_CONNECTION_ERROR_TYPES = {
+    'NameResolutionError': 'ERR_NAME_NOT_RESOLVED',
+    'ConnectTimeoutError': 'timeout',
+    'RemoteDisconnected': 'ERR_CONNECTION_RESET',
+    'Connection refused': 'ERR_CONNECTION_REFUSED',
+}
+
+
+def _connection_error_cause(error: Exception) -> BaseException | None:
+    """
+    Unwrap requests' and urllib3's wrappers around a connection error to get
+    at the actual error.
+    """
+    from urllib3.exceptions import MaxRetryError, ProtocolError
+
+    cause = error.args[0] if error.args else None
+    if isinstance(cause, MaxRetryError):
+        cause = cause.reason
+    if isinstance(cause, ProtocolError) and len(cause.args) > 1:
+        cause = cause.args[1]
+    return cause
+
+
+def _connection_error_type(error: Exception) -> str | None:
+    """
+    Get the browser-style error name for a connection error from requests, or
+    ``None`` if it is not the kind of error a precheck should report.
+    """
+    from http.client import RemoteDisconnected
+    from urllib3.exceptions import (
+        ConnectTimeoutError,
+        NameResolutionError,
+        NewConnectionError,
+    )
+
+    cause = _connection_error_cause(error)
+
+    # NOTE: order matters! NameResolutionError is a NewConnectionError, which
+    # is in turn a ConnectTimeoutError (for backwards-compatibility reasons).
+    if isinstance(cause, NameResolutionError):
+        return 'ERR_NAME_NOT_RESOLVED'
+    elif isinstance(cause, NewConnectionError):
+        if isinstance(cause.__cause__, ConnectionRefusedError):
+            return 'ERR_CONNECTION_REFUSED'
+    elif isinstance(cause, ConnectTimeoutError):
+        return 'timeout'
+    elif isinstance(cause, RemoteDisconnected):
+        return 'ERR_CONNECTION_RESET'
+
+    match = _CONNECTION_ERROR_PATTERN.search(str(error))
+    if match:
+        return _CONNECTION_ERROR_TYPES[match.group(0)]
+
+    # Ignore other types of connection errors, e.g. SSL failures, which
+    # browsers (and our crawler) may handle less strictly.
+    return None